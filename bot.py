@@ -1,13 +1,20 @@
+import asyncio
+import hashlib
 import json
+import logging
+import re
+from contextlib import asynccontextmanager
+from cachetools import TTLCache
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
 import sqlite3
+import aiosqlite
 import google.generativeai as genai
 from instruction import system_instruction
 from dotenv import load_dotenv
 from colorama import Fore, Style
 import os
-from utils import verify_payment
+from utils import client, verify_payment
 
 # Load environment variables
 load_dotenv()
@@ -32,24 +39,48 @@ model = genai.GenerativeModel(
     generation_config=generation_config,
 )
 
-# SQLite Database Setup
-conn = sqlite3.connect("user_data.db", check_same_thread=False)
-cursor = conn.cursor()
-
-# Logging function
-def logger(level, message):
-    levels = {
-        "USER": Fore.GREEN,
-        "BOT": Fore.CYAN,
-        "DEBUG": Fore.YELLOW,
-        "ERROR": Fore.RED
-    }
-    color = levels.get(level, Fore.WHITE)
-    print(f"{color}[{level}] {message}{Style.RESET_ALL}")
+# SQLite Database Setup (pool filled in on_startup via app.post_init).
+# Under WAL, pooled readers run in parallel while a writer commits.
+POOL_SIZE = 4
+_pool = None
+
+@asynccontextmanager
+async def acquire():
+    conn = await _pool.get()
+    try:
+        yield conn
+    finally:
+        _pool.put_nowait(conn)
+
+# Logging: backed by the logging module so arguments are only formatted when
+# the level is enabled (set LOG_LEVEL=DEBUG to see plans and payment traces)
+_LOG_COLORS = {
+    "USER": Fore.GREEN,
+    "BOT": Fore.CYAN,
+    "DEBUG": Fore.YELLOW,
+    "ERROR": Fore.RED
+}
+
+class _ColorFormatter(logging.Formatter):
+    def format(self, record):
+        tag = getattr(record, "tag", record.levelname)
+        color = _LOG_COLORS.get(tag, Fore.WHITE)
+        return f"{color}[{tag}] {record.getMessage()}{Style.RESET_ALL}"
+
+_handler = logging.StreamHandler()
+_handler.setFormatter(_ColorFormatter())
+log = logging.getLogger("hahahash")
+log.addHandler(_handler)
+log.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+_LOG_LEVELS = {"DEBUG": logging.DEBUG, "ERROR": logging.ERROR}
+
+def logger(level, message, *args):
+    log.log(_LOG_LEVELS.get(level, logging.INFO), message, *args, extra={"tag": level})
 
 # Table creation
-def create_tables():
-    cursor.execute("""
+async def create_tables(conn):
+    await conn.execute("""
     CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY,
         telegram_id INTEGER UNIQUE,
@@ -57,7 +88,7 @@ def create_tables():
         message_count INTEGER DEFAULT 0
     )
     """)
-    cursor.execute("""
+    await conn.execute("""
     CREATE TABLE IF NOT EXISTS messages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
@@ -67,7 +98,7 @@ def create_tables():
         FOREIGN KEY(user_id) REFERENCES users(id)
     )
     """)
-    cursor.execute("""
+    await conn.execute("""
     CREATE TABLE IF NOT EXISTS wallets (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER UNIQUE,
@@ -75,7 +106,7 @@ def create_tables():
         FOREIGN KEY(user_id) REFERENCES users(id)
     )
     """)
-    cursor.execute("""
+    await conn.execute("""
     CREATE TABLE IF NOT EXISTS payments (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
@@ -86,61 +117,164 @@ def create_tables():
         FOREIGN KEY(user_id) REFERENCES users(id)
     )
     """)
-    conn.commit()
+    # Covers get_user_history's WHERE user_id + ORDER BY timestamp
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages(user_id, timestamp)")
+    await conn.commit()
 
-create_tables()
+# Hot statements as module constants so every call presents SQLite's
+# prepared-statement cache with the identical SQL text
+SQL_INSERT_USER = "INSERT OR IGNORE INTO users (telegram_id, name) VALUES (?, ?)"
+SQL_SELECT_USER_ID = "SELECT id FROM users WHERE telegram_id = ?"
+SQL_BUMP_COUNT = "UPDATE users SET message_count = message_count + 1 WHERE id = ? RETURNING message_count"
+SQL_INSERT_MESSAGE = "INSERT INTO messages (user_id, message, role) VALUES (?, ?, ?)"
+SQL_SELECT_HISTORY = "SELECT message, role FROM messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?"
 
 # Helper functions
-def execute_query(query, params=(), fetch=False):
-    cursor.execute(query, params)
-    if fetch:
-        return cursor.fetchall()
-    conn.commit()
+async def execute_query(query, params=(), fetch=False):
+    async with acquire() as conn:
+        # Roll back on failure so the connection goes back to the pool without
+        # an open write transaction (which would stall other writers under WAL)
+        try:
+            async with conn.execute(query, params) as cur:
+                if fetch:
+                    return await cur.fetchall()
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+async def ensure_user(telegram_id, name):
+    await execute_query(SQL_INSERT_USER, (telegram_id, name))
+
+# telegram_id -> users.id cache; the mapping never changes once the row exists
+_uid_cache = {}
+
+async def get_user_id(telegram_id):
+    user_id = _uid_cache.get(telegram_id)
+    if user_id is None:
+        result = await execute_query(SQL_SELECT_USER_ID, (telegram_id,), fetch=True)
+        if not result:
+            return None
+        user_id = result[0][0]
+        _uid_cache[telegram_id] = user_id
+    return user_id
 
-def ensure_user(telegram_id, name):
-    execute_query("INSERT OR IGNORE INTO users (telegram_id, name) VALUES (?, ?)", (telegram_id, name))
+async def begin_chat_turn(telegram_id, name, message):
+    # All pre-LLM writes for a chat turn under a single commit: user upsert,
+    # count bump, and (if under the limit) the user message insert. The uid
+    # lookup reuses the held connection rather than re-acquiring from the pool.
+    async with acquire() as conn:
+        try:
+            await conn.execute(SQL_INSERT_USER, (telegram_id, name))
+            user_id = _uid_cache.get(telegram_id)
+            if user_id is None:
+                async with conn.execute(SQL_SELECT_USER_ID, (telegram_id,)) as cur:
+                    row = await cur.fetchone()
+                user_id = row[0]
+                _uid_cache[telegram_id] = user_id
+            async with conn.execute(SQL_BUMP_COUNT, (user_id,)) as cur:
+                row = await cur.fetchone()
+            message_count = row[0] if row else 0
+            if message_count <= 20:
+                await conn.execute(SQL_INSERT_MESSAGE, (user_id, message, "user"))
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+    return user_id, message_count
+
+async def store_message(user_id, message, role):
+    await execute_query(SQL_INSERT_MESSAGE, (user_id, message, role))
 
-def get_user_id(telegram_id):
-    result = execute_query("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,), fetch=True)
-    return result[0][0] if result else None
+async def get_user_history(user_id, limit=40):
+    # Only the most recent messages go into the prompt, keeping Gemini input
+    # tokens (and therefore cost and latency) bounded as the chat grows
+    rows = await execute_query(SQL_SELECT_HISTORY, (user_id, limit), fetch=True)
+    return rows[::-1]
 
-def increment_message_count(user_id):
-    execute_query("UPDATE users SET message_count = message_count + 1 WHERE id = ?", (user_id,))
-    result = execute_query("SELECT message_count FROM users WHERE id = ?", (user_id,), fetch=True)
-    return result[0][0] if result else 0
+# Hourly maintenance: purge messages older than 30 days and refresh planner
+# stats so history scans stay bounded as the table ages. The task handle is
+# kept so the loop can't be garbage-collected mid-run and gets cancelled at
+# shutdown.
+_gc_task = None
 
-def store_message(user_id, message, role):
-    execute_query("INSERT INTO messages (user_id, message, role) VALUES (?, ?, ?)", (user_id, message, role))
+async def _gc_loop():
+    while True:
+        await asyncio.sleep(3600)
+        try:
+            await execute_query("DELETE FROM messages WHERE timestamp < datetime('now', '-30 days')")
+            await execute_query("ANALYZE")
+        except Exception as e:
+            logger("ERROR", "Error in messages GC: %s", e)
 
-def get_user_history(user_id):
-    return execute_query("SELECT message, role FROM messages WHERE user_id = ? ORDER BY timestamp", (user_id,), fetch=True)
+# Responses cached by prompt hash: identical histories (onboarding, "hi", etc.)
+# skip the ~500-2000 ms Gemini call entirely
+_llm_cache = TTLCache(maxsize=5000, ttl=3600)
 
-def generate_response(history):
+# Locates the start of the user-visible reply inside the streamed JSON; the
+# plan that precedes it is never forwarded
+_MESSAGE_KEY = re.compile(r'"message"\s*:\s*"')
+
+async def _stream_to_message(prompt, reply_msg):
+    # Stream generation and forward partial text to the placeholder message,
+    # so the user sees the reply growing from time-to-first-token instead of
+    # waiting for the full generation
+    loop = asyncio.get_running_loop()
+    buf = ""
+    shown = ""
+    last_edit = 0.0
+    stream = await model.generate_content_async(prompt, stream=True)
+    async for chunk in stream:
+        buf += chunk.text
+        match = _MESSAGE_KEY.search(buf)
+        if not match:
+            continue
+        partial = buf[match.end():].split('"')[0]
+        if partial and partial != shown and loop.time() - last_edit > 0.5:
+            try:
+                await reply_msg.edit_text(partial)
+                shown = partial
+                last_edit = loop.time()
+            except Exception:
+                pass  # edits are best-effort; the final edit settles the text
+    return buf
+
+async def generate_response(history, reply_msg):
     try:
-        full_prompt = "\n".join(f"{role.capitalize()}: {msg}" for msg, role in history)
-        response = model.generate_content(full_prompt)
-        result = json.loads(response.text.replace("```json", "").replace("```", "").strip())
-        logger("DEBUG", f"Agent Plan: {json.dumps(result['plan'], indent=4)}")
-        return result["message"]
+        full_prompt = "\n".join([f"{role.capitalize()}: {msg}" for msg, role in history])
+        key = hashlib.sha256(full_prompt.encode()).hexdigest()
+        message = _llm_cache.get(key)
+        if message is None:
+            text = await _stream_to_message(full_prompt, reply_msg)
+            # Parse straight from the first "{" instead of stripping ```json
+            # fences with two full-string replace passes
+            result, _ = json.JSONDecoder().raw_decode(text, text.find("{"))
+            logger("DEBUG", "Agent Plan: %s", result["plan"])
+            message = result["message"]
+            _llm_cache[key] = message
     except Exception as e:
-        logger("ERROR", f"Error in generate_response: {e}")
-        return f"Error: {str(e)}"
+        logger("ERROR", "Error in generate_response: %s", e)
+        message = f"Error: {str(e)}"
+    try:
+        await reply_msg.edit_text(message)
+    except Exception:
+        pass  # the last streamed edit may already hold the final text
+    return message
 
 # Telegram Handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    ensure_user(user.id, user.first_name)
-    logger("USER", f"User {user.first_name} ({user.id}) started the bot.")
+    await ensure_user(user.id, user.first_name)
+    logger("USER", "User %s (%s) started the bot.", user.first_name, user.id)
     await update.message.reply_text(f"Hey what would you like to be called and where are you from?")
 
 async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    ensure_user(user.id, user.first_name)
-    user_id = get_user_id(user.id)
-    message_count = increment_message_count(user_id)
+    user_message = update.message.text
+    user_id, message_count = await begin_chat_turn(user.id, user.first_name, user_message)
 
     if message_count > 20:
-        result = execute_query("SELECT wallet_address FROM wallets WHERE user_id = ?", (user_id,), fetch=True)
+        result = await execute_query("SELECT wallet_address FROM wallets WHERE user_id = ?", (user_id,), fetch=True)
         if not result:
             await update.message.reply_text("Provide your wallet address first. Use /wallet <wallet_address>.")
         else:
@@ -149,47 +283,49 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         return
 
-    user_message = update.message.text
-    logger("USER", f"User {user.first_name} ({user.id}): {user_message}")
-    store_message(user_id, user_message, "user")
-    history = get_user_history(user_id)
-    bot_response = generate_response(history)
-    logger("BOT", f"Bot: {bot_response}")
-    store_message(user_id, bot_response, "bot")
-    await update.message.reply_text(bot_response)
+    logger("USER", "User %s (%s): %s", user.first_name, user.id, user_message)
+    history = await get_user_history(user_id)
+    reply_msg = await update.message.reply_text("...")
+    bot_response = await generate_response(history, reply_msg)
+    logger("BOT", "Bot: %s", bot_response)
+    await store_message(user_id, bot_response, "bot")
 
 async def paid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    ensure_user(user.id, user.first_name)
-    user_id = get_user_id(user.id)
-    result = execute_query("SELECT wallet_address FROM wallets WHERE user_id = ?", (user_id,), fetch=True)
+    await ensure_user(user.id, user.first_name)
+    user_id = await get_user_id(user.id)
+    result = await execute_query("SELECT wallet_address FROM wallets WHERE user_id = ?", (user_id,), fetch=True)
 
     if not result:
         await update.message.reply_text("Provide your wallet address first. Use /wallet <wallet_address>.")
         return
 
     wallet_address = result[0][0]
-    txn_id = verify_payment(CRYPTO_WALLET_ADDRESS, wallet_address, 0.001)
+    txn_id = await verify_payment(CRYPTO_WALLET_ADDRESS, wallet_address, 0.001)
 
     if txn_id:
         try:
-            execute_query("""
+            await execute_query("""
             INSERT INTO payments (user_id, transaction_id, amount, status)
             VALUES (?, ?, ?, 'verified')""", (user_id, txn_id, 0.001))
-            execute_query("UPDATE users SET message_count = 0 WHERE id = ?", (user_id,))
-            logger("DEBUG", f"Payment verified for user {user.first_name} ({user.id}). Transaction ID: {txn_id}")
+            await execute_query("UPDATE users SET message_count = 0 WHERE id = ?", (user_id,))
+            logger("DEBUG", "Payment verified for user %s (%s). Transaction ID: %s", user.first_name, user.id, txn_id)
             await update.message.reply_text("Payment verified!")
         except Exception as e:
-            logger("ERROR", f"Error in /paid: {e}")
+            logger("ERROR", "Error in /paid: %s", e)
             await update.message.reply_text("Payment already used!")
     else:
         logger("DEBUG", "Payment not found.")
         await update.message.reply_text("Payment not found.")
 
+# Solana addresses are base58 (no 0, O, I, l), 32-44 chars; the regex rejects
+# bad input at the first offending character
+_B58 = re.compile(r"^[1-9A-HJ-NP-Za-km-z]{32,44}$")
+
 async def wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    ensure_user(user.id, user.first_name)
-    user_id = get_user_id(user.id)
+    await ensure_user(user.id, user.first_name)
+    user_id = await get_user_id(user.id)
 
     if not context.args:
         await update.message.reply_text(
@@ -200,31 +336,61 @@ async def wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     wallet_address = context.args[0]
 
-    if len(wallet_address) != 44 or not wallet_address.isalnum():
+    if not _B58.match(wallet_address):
         await update.message.reply_text(
             "Invalid wallet address format. Please ensure it is a valid Solana wallet address."
         )
         return
 
     try:
-        execute_query("""
+        await execute_query("""
             INSERT INTO wallets (user_id, wallet_address)
             VALUES (?, ?)
             ON CONFLICT(user_id) DO UPDATE SET wallet_address = excluded.wallet_address
         """, (user_id, wallet_address))
-        logger("DEBUG", f"Wallet address saved for user {user.first_name} ({user.id}): {wallet_address}")
+        logger("DEBUG", "Wallet address saved for user %s (%s): %s", user.first_name, user.id, wallet_address)
         await update.message.reply_text(
             f"Your wallet address has been saved successfully: `{wallet_address}`",
             parse_mode="Markdown"
         )
     except sqlite3.IntegrityError as e:
-        logger("ERROR", f"Error saving wallet address: {e}")
+        logger("ERROR", "Error saving wallet address: %s", e)
         await update.message.reply_text(
             "There was an error saving your wallet address. Please try again."
         )
 
+# Startup hook: open the database pool before handlers start receiving updates
+async def on_startup(application):
+    global _pool, _gc_task
+    _pool = asyncio.Queue()
+    for _ in range(POOL_SIZE):
+        conn = await aiosqlite.connect("user_data.db", cached_statements=256)
+        # WAL lets reads proceed during writes and drops per-commit fsync cost
+        await conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "PRAGMA temp_store=MEMORY;"
+            "PRAGMA mmap_size=268435456;"
+            "PRAGMA cache_size=-65536;"
+        )
+        _pool.put_nowait(conn)
+    async with acquire() as conn:
+        await create_tables(conn)
+    _gc_task = asyncio.create_task(_gc_loop())
+
+# Shutdown hook: close pooled resources, else each aiosqlite connection's
+# non-daemon worker thread keeps the interpreter alive after run_polling
+# returns and docker stop ends in SIGKILL
+async def on_shutdown(application):
+    if _gc_task is not None:
+        _gc_task.cancel()
+    while _pool is not None and not _pool.empty():
+        conn = _pool.get_nowait()
+        await conn.close()
+    await client.aclose()
+
 # Bot setup
-app = ApplicationBuilder().token(TOKEN).build()
+app = ApplicationBuilder().token(TOKEN).post_init(on_startup).post_shutdown(on_shutdown).build()
 app.add_handler(CommandHandler("start", start))
 app.add_handler(CommandHandler("paid", paid))
 app.add_handler(CommandHandler("wallet", wallet))
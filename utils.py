@@ -1,4 +1,6 @@
-import requests
+import httpx
+import ijson
+from cachetools import TTLCache
 from dotenv import load_dotenv
 import os
 
@@ -8,8 +10,15 @@ load_dotenv()
 TENOR_API_KEY = os.getenv("TENOR_API_KEY")
 CRYPTO_WALLET_ADDRESS = os.getenv("CRYPTO_WALLET_ADDRESS")
 
+# Shared async client: keep-alive pooling amortizes TCP/TLS setup across calls
+client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_keepalive_connections=20))
 
-def fetch_memes(search_terms: str):
+# Signatures already inspected per sender wallet; users spamming /paid only
+# trigger lookups for transactions that appeared since the last attempt
+_seen_sigs = TTLCache(maxsize=10_000, ttl=600)
+
+
+async def fetch_memes(search_terms: str):
     """
     Fetch a list of GIFs or images from Tenor based on search keywords.
 
@@ -25,7 +34,7 @@ def fetch_memes(search_terms: str):
         "q": search_terms,
         "limit": 5,
     }
-    response = requests.get(base_url, params=params)
+    response = await client.get(base_url, params=params)
     if response.status_code == 200:
         return [
             {
@@ -39,7 +48,7 @@ def fetch_memes(search_terms: str):
     return []
 
 
-def verify_payment(receiving_wallet: str, sender_wallet: str, expected_amount: float = 0.001):
+async def verify_payment(receiving_wallet: str, sender_wallet: str, expected_amount: float = 0.001):
     """
     Verify that a specific amount of SOL has been received from a given sender wallet.
 
@@ -52,7 +61,12 @@ def verify_payment(receiving_wallet: str, sender_wallet: str, expected_amount: f
         str: The transaction signature if the payment is verified, else None.
     """
     SOLANA_RPC_URL = "https://api.devnet.solana.com"  # Use Devnet URL for testing
-    headers = {"Content-Type": "application/json"}
+    # Compare in integer lamports; dividing by 1e9 and comparing floats can
+    # spuriously miss an exact payment
+    expected_lamports = int(round(expected_amount * 1e9))
+    # getTransaction replies can be tens of KB; gzip cuts the transfer 3-10x
+    # and httpx decompresses transparently
+    headers = {"Content-Type": "application/json", "Accept-Encoding": "gzip"}
 
     # Fetch recent transaction signatures for the sender wallet
     payload = {
@@ -61,31 +75,50 @@ def verify_payment(receiving_wallet: str, sender_wallet: str, expected_amount: f
         "method": "getSignaturesForAddress",
         "params": [sender_wallet, {"limit": 20}]
     }
-    response = requests.post(SOLANA_RPC_URL, headers=headers, json=payload)
+    response = await client.post(SOLANA_RPC_URL, headers=headers, json=payload)
     
     if response.status_code != 200:
         print("Error fetching transaction signatures:", response.text)
         return None
 
-    transactions = response.json().get("result", [])
-    for txn in transactions:
-        # Fetch detailed transaction info
-        txn_payload = {
+    seen = _seen_sigs.get(sender_wallet, set())
+    transactions = [
+        txn for txn in response.json().get("result", [])
+        if txn["signature"] not in seen
+    ]
+    if not transactions:
+        return None
+
+    # Fetch all transaction details in one JSON-RPC batch request instead of
+    # one sequential round-trip per signature
+    batch_payload = [
+        {
             "jsonrpc": "2.0",
-            "id": 1,
+            "id": i,
             "method": "getTransaction",
             "params": [txn["signature"], "jsonParsed"]
         }
-        txn_response = requests.post(SOLANA_RPC_URL, headers=headers, json=txn_payload)
-        
-        if txn_response.status_code != 200:
-            print(f"Error fetching transaction details for {txn['signature']}: {txn_response.text}")
-            continue
+        for i, txn in enumerate(transactions)
+    ]
+    batch_response = await client.post(SOLANA_RPC_URL, headers=headers, json=batch_payload)
+
+    if batch_response.status_code != 200:
+        print("Error fetching transaction details:", batch_response.text)
+        return None
 
-        txn_data = txn_response.json().get("result", {})
+    # Stream the batch reply: each result is parsed lazily and the scan stops
+    # at the first matching transfer instead of materializing the whole
+    # multi-transaction JSON tree up front
+    inspected = set()
+    for reply in ijson.items(batch_response.content, "item"):
+        # A null/missing result (node catching up, per-request error) was not
+        # inspected, so leave it out of the seen set and retry it next time
+        txn_data = reply.get("result") or {}
         if not txn_data:
             continue
 
+        signature = transactions[reply["id"]]["signature"]
+        inspected.add(signature)
         instructions = txn_data.get("transaction", {}).get("message", {}).get("instructions", [])
         for instruction in instructions:
             # Check if the instruction involves a transfer to the receiving wallet
@@ -93,11 +126,10 @@ def verify_payment(receiving_wallet: str, sender_wallet: str, expected_amount: f
             if parsed and parsed.get("info", {}).get("destination") == receiving_wallet:
                 source = parsed.get("info", {}).get("source")
                 lamports = int(parsed.get("info", {}).get("lamports", 0))
-                amount_received = lamports / 1e9  # Convert lamports to SOL
-                # print(f"Amount received: {amount_received}")
                 # Verify the source and amount
-                if source == sender_wallet and amount_received == expected_amount:
-                    return txn["signature"]  # Return the transaction signature if matched
+                if source == sender_wallet and lamports == expected_lamports:
+                    return signature  # Return the transaction signature if matched
 
+    _seen_sigs[sender_wallet] = seen | inspected
     return None
  